@@ -1,23 +1,34 @@
-from typing import Union, Tuple
-import json
-import urllib.request
+from typing import Union, Iterator
+import asyncio
 import glob
+import mmap
+import aiofiles
+import aiohttp
+import orjson
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import os
-import numpy as np
-from scipy import stats
 import geopandas as gpd
 import logging
 from config import (
     RAW_DATA_ROOM_API_CALL_DIR,
     RAW_DATA_MAIN_API_CALL_DIR,
     PARSED_ACCOMM_FILE,
+    PARSED_ACCOMM_DTYPES,
     PREPARED_ACCOMM_FILE,
+    PREPARED_ACCOMM_PARQUET,
     ROOM_INFO_FILE,
+    LEGACY_ROOM_INFO_FILE,
     DIRS,
     MAPPING_CATEGORY_SINGULAR_PLURAL,
-    POPULATION_SHAPEFILE
+    LATITUDE_RANGE,
+    LONGITUDE_RANGE
 )
+from geo import load_population
 
 logging.basicConfig(
     level=logging.INFO,
@@ -29,6 +40,14 @@ logging.basicConfig(
 
 MSG = "\n{}\n========"
 
+ACCOMMODATION_API_URL = "https://tourism.api.opendatahub.bz.it/v1/Accommodation"
+
+# Maximum number of API calls in flight at any time
+MAX_CONCURRENT_REQUESTS = 50
+
+# Number of attempts made for each API call before giving up
+MAX_ATTEMPTS = 5
+
 
 def download_data():
     """
@@ -36,23 +55,98 @@ def download_data():
     Saves paginated API results as JSON to disk.
     """
     logging.info(MSG.format("Downloading tourism data"))
-    page = "https://tourism.api.opendatahub.bz.it/v1/Accommodation"
-    counter = 0
-    while True:
-        if counter == 0:
-            logging.info(
-                "{:,} results broken into {:,} pages"
-                .format(data.get("TotalResults"), data.get("TotalPages"))
-            )
-        if counter % 10 == 0:
-            logging.info(f"Page number {counter + 1:,}")
-        with urllib.request.urlopen(page) as response:
-            data = json.loads(response.read())
-            page = data.get("NextPage")
-            json.dump(data, open(os.path.join(RAW_DATA_MAIN_API_CALL_DIR, f"page_{counter}.json"), "w"))
-            counter += 1
-            if not page:
-                break
+    asyncio.run(_download_data())
+
+
+async def _download_data():
+    """
+    Downloads all pages of accommodation data concurrently, see `download_data()`.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    async with _client_session() as session:
+        # The first page reveals the total number of pages, which can then be downloaded concurrently
+        data = await _download_page(session, semaphore, 1)
+        total_pages = data.get("TotalPages")
+        logging.info(
+            "{:,} results broken into {:,} pages"
+            .format(data.get("TotalResults"), total_pages)
+        )
+        tasks = [_download_page(session, semaphore, page_number) for page_number in range(2, total_pages + 1)]
+        for counter, task in enumerate(asyncio.as_completed(tasks), start=2):
+            await task
+            if counter % 10 == 0:
+                logging.info(f"Downloaded {counter:,} pages")
+
+
+async def _download_page(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, page_number: int) -> dict:
+    """
+    Downloads a single page of accommodation data and saves it as JSON to disk.
+
+    Parameters
+    ----------
+    session: The HTTP session used to make the API call.
+    semaphore: Semaphore limiting the number of concurrent API calls.
+    page_number: Number of the page to download, starting at 1.
+
+    Returns
+    -------
+    data: The API results of the page.
+    """
+    content = await _fetch(session, semaphore, ACCOMMODATION_API_URL, params={"pagenumber": page_number})
+    async with aiofiles.open(os.path.join(RAW_DATA_MAIN_API_CALL_DIR, f"page_{page_number - 1}.json"), "wb") as f:
+        await f.write(content)
+    return orjson.loads(content)
+
+
+def _client_session() -> aiohttp.ClientSession:
+    """
+    Creates the HTTP session shared by concurrent API calls, so that they re-use pooled keep-alive connections.
+    """
+    # Connections to the API host are kept alive and DNS lookups are cached, avoiding repeated handshakes
+    connector = aiohttp.TCPConnector(
+        limit=MAX_CONCURRENT_REQUESTS,
+        limit_per_host=MAX_CONCURRENT_REQUESTS,
+        ttl_dns_cache=600,
+        keepalive_timeout=60
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=30)
+    )
+
+
+async def _fetch(
+        session: aiohttp.ClientSession,
+        semaphore: asyncio.Semaphore,
+        url: str,
+        params: dict = None
+) -> bytes:
+    """
+    Makes a GET request, retrying with exponential backoff on connection errors, timeouts and server errors (5xx).
+
+    Parameters
+    ----------
+    session: The HTTP session used to make the API call.
+    semaphore: Semaphore limiting the number of concurrent API calls.
+    url: The URL to request.
+    params: Query parameters to add to the URL, if any.
+
+    Returns
+    -------
+    content: The body of the response.
+    """
+    async with semaphore:
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                async with session.get(url, params=params) as response:
+                    response.raise_for_status()
+                    return await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # Client errors (4xx), e.g. an unknown ID, would fail again, hence are not retried
+                is_client_error = isinstance(e, aiohttp.ClientResponseError) and e.status < 500
+                if is_client_error or attempt == MAX_ATTEMPTS - 1:
+                    raise
+                await asyncio.sleep(0.5 * 2 ** attempt)
 
 
 def parse_data():
@@ -61,15 +155,30 @@ def parse_data():
     """
     logging.info(MSG.format("Parsing tourism data"))
     files = glob.glob(os.path.join(RAW_DATA_MAIN_API_CALL_DIR, "*.json"))
-    parsed_data = []
-    for file in files:
-        entries = json.load(open(file, "r")).get("Items")
-        for entry in entries:
-            parsed_data.append(_parse_entry(entry, file))
-    df = pd.DataFrame(parsed_data)
+    # Frames are built page by page, so that only one page of parsed entries is held as dicts at any time
+    df = pd.concat(_iter_pages(files), ignore_index=True)
     df.to_csv(PARSED_ACCOMM_FILE, index=False)
 
 
+def _iter_pages(files: list) -> Iterator[pd.DataFrame]:
+    """
+    Lazily parses paginated API results, one page at a time.
+
+    Parameters
+    ----------
+    files: Paths of the JSON files containing the paginated API results.
+
+    Returns
+    -------
+    pages: Generator of dataframes, one per page, whose rows are parsed API return objects, see `_parse_entry()`.
+    """
+    for file in files:
+        # Decode straight from the memory-mapped file, without first copying its contents into a bytes object
+        with open(file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as buffer:
+            entries = orjson.loads(buffer).get("Items", [])
+        yield pd.DataFrame.from_records([_parse_entry(entry, file) for entry in entries])
+
+
 def _parse_entry(entry: dict, file: str = None) -> dict:
     """
     Selects only most relevant information from an original API return object.
@@ -83,40 +192,22 @@ def _parse_entry(entry: dict, file: str = None) -> dict:
     -------
     parsed_entry: Parsed API return object, which includes only relevant attributes.
     """
-    of_interest = [
-        "AccoDetail",
-        "AccoCategoryId",
-        "AccoRoomInfo",
-        "HasApartment",
-        "IsGastronomy",
-        "LocationInfo",
-        "Altitude",
-        "Latitude",
-        "Longitude",
-        "Id"
-    ]
-
-    parsed_entry = {}
-    for attribute in of_interest:
-        attribute_value = entry.get(attribute)
-        if (attribute in ["AccoDetail", "LocationInfo"]) & (attribute_value is not None):
-            if attribute == "AccoDetail":
-                attribute_value_lang = attribute_value.get("de")
-                for c in ["Name", "City"]:
-                    parsed_entry[c] = attribute_value_lang.get(c)
-            elif attribute == "LocationInfo":
-                try:
-                    attribute_value_lang = attribute_value.get("RegionInfo").get("Name").get("de")
-                except KeyError:
-                    attribute_value_lang = None
-                parsed_entry[attribute] = attribute_value_lang
-            else:
-                pass
-        else:
-            if attribute == "AccoRoomInfo":
-                parsed_entry[attribute] = len(attribute_value) if attribute_value is not None else None
-            else:
-                parsed_entry[attribute] = attribute_value
+    acco_detail = (entry.get("AccoDetail") or {}).get("de") or {}
+    region_info = (entry.get("LocationInfo") or {}).get("RegionInfo") or {}
+    room_info = entry.get("AccoRoomInfo")
+    parsed_entry = {
+        "Name": acco_detail.get("Name"),
+        "City": acco_detail.get("City"),
+        "AccoCategoryId": entry.get("AccoCategoryId"),
+        "AccoRoomInfo": len(room_info) if room_info is not None else None,
+        "HasApartment": entry.get("HasApartment"),
+        "IsGastronomy": entry.get("IsGastronomy"),
+        "LocationInfo": (region_info.get("Name") or {}).get("de"),
+        "Altitude": entry.get("Altitude"),
+        "Latitude": entry.get("Latitude"),
+        "Longitude": entry.get("Longitude"),
+        "Id": entry.get("Id")
+    }
     parsed_entry["file"] = file
     return parsed_entry
 
@@ -129,61 +220,53 @@ def prepare_data():
     """
     logging.info(MSG.format("Preparing data"))
     # Main file
-    df = pd.read_csv(PARSED_ACCOMM_FILE)
+    df = pd.read_csv(PARSED_ACCOMM_FILE, dtype=PARSED_ACCOMM_DTYPES)
     # File containing room and max occupancy info
-    room_info = pd.read_csv(ROOM_INFO_FILE)
+    _migrate_room_info()
+    room_info = pd.read_parquet(ROOM_INFO_FILE)
     dupl_cols = list(df.columns.difference(["file"]))
     # Remove duplicates
     logging.info(f"Number of duplicates: {df[dupl_cols].duplicated().sum():,}")
     df.drop_duplicates(subset=dupl_cols, inplace=True)
-    # Remove outliers in terms of GPS coordinates (e.g. those with Lat or Long equal to zero)
-    mask = (np.abs(stats.zscore(df[["Latitude", "Longitude"]])) >= 0.5).all(axis=1)
-    logging.info(f"Number of invalid GPS coordinates: {mask.sum():,}")
-    df = df.loc[~mask].copy()
-    # Parse category information
+    # Remove GPS coordinates outside of South Tyrol (e.g. those with Lat or Long equal to zero)
+    mask = df.Latitude.between(*LATITUDE_RANGE) & df.Longitude.between(*LONGITUDE_RANGE)
+    logging.info(f"Number of invalid GPS coordinates: {(~mask).sum():,}")
+    df = df.loc[mask].copy()
+    # Parse category information, e.g. "3sstars" -> ("3S", "Stars") and "2flowers" -> ("2", "Flowers")
+    category = df.AccoCategoryId.where(df.AccoCategoryId != "Not categorized")
+    is_ss = category.str.contains("ss", na=False, regex=False)  # 4s or 3s hotels
     df["AccoCategoryRating"] = (
-        df
-        .AccoCategoryId
-        .apply(lambda x: _parse_category(x)[0])
-        .str
-        .title()
+        category.str[:2]
+        .where(is_ss, category.str[:1])
+        .str.title()
     )
     df["AccoCategoryType"] = (
-        df
-        .AccoCategoryId
-        .apply(lambda x: _parse_category(x)[1])
+        category.str[2:]
+        .where(is_ss, category.str[1:])
         .replace(MAPPING_CATEGORY_SINGULAR_PLURAL)
         .str.title()
     )
-    # Get OHE
-    n = len(df)
-    df = (
-        df
-        .merge(
-            pd.get_dummies(
-                df[["Id", "AccoCategoryType", "AccoCategoryRating"]],
-                columns=["AccoCategoryType", "AccoCategoryRating"]
-            ),
-            on="Id",
-            how="inner"
-        )
-    )
-    assert len(df) == n
+    # Get OHE, e.g. "AccoCategoryType_Stars" or "AccoCategoryRating_3S"
+    for col in ["AccoCategoryType", "AccoCategoryRating"]:
+        for cat in sorted(df[col].dropna().unique()):
+            df[f"{col}_{cat}"] = (df[col] == cat).astype("uint8")
     # Add municipality info
     n = len(df)
     df_geo = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.Longitude, df.Latitude), crs="EPSG:4326")
-    population = gpd.read_file(POPULATION_SHAPEFILE, crs="EPSG:4326")
-    population = population.to_crs("EPSG:4326")
-    population.drop_duplicates(subset=["NAME_D"], inplace=True)
-    df = gpd.sjoin(df_geo, population[["NAME_D", "NAME_I", "geometry"]], how="left", op="within")
+    population = load_population()
+    # Bulk query of the municipalities' spatial index: returns pairs of (point, municipality) positions
+    point_idx, municipality_idx = population.sindex.query_bulk(df_geo.geometry, predicate="within")
+    municipalities = population[["NAME_D", "NAME_I"]].iloc[municipality_idx].set_index(df_geo.index[point_idx])
+    municipalities = municipalities[~municipalities.index.duplicated()]
+    df = df_geo.join(municipalities, how="left")
     assert len(df) == n
     # Merge with room info
     n = len(df)
     df["Id"] = df["Id"].str.rstrip("_REDUCED")  # New IDs end with "_REDUCED"
     df = df.merge(room_info, on="Id", how="left")
     assert len(df) == n
-    df.drop(columns=["index_right"], inplace=True)  # Created by spatial join
     df.to_csv(PREPARED_ACCOMM_FILE, index=False)
+    df.to_parquet(PREPARED_ACCOMM_PARQUET, index=False)
 
 
 def download_room_info():
@@ -192,47 +275,124 @@ def download_room_info():
     """
     logging.info(MSG.format("Downloading room information"))
 
-    api_calls = 0
-    if os.path.exists(PREPARED_ACCOMM_FILE):
+    # Only the Id column is read, straight into an Arrow array
+    if os.path.exists(PREPARED_ACCOMM_PARQUET):
         # Use merged data to see which cleaned establishments ones we already have
-        accommodation_ids = set(pd.read_csv(PREPARED_ACCOMM_FILE).Id.str.rstrip("_REDUCED").unique())
+        ids = pq.read_table(PREPARED_ACCOMM_PARQUET, columns=["Id"])["Id"]
     else:
         # Otherwise, start with the full list of establishments
-        accommodation_ids = set(pd.read_csv(PARSED_ACCOMM_FILE).Id.str.rstrip("_REDUCED").unique())
-    new_ids = accommodation_ids
+        convert_options = pa_csv.ConvertOptions(include_columns=["Id"], column_types={"Id": pa.string()})
+        ids = pa_csv.read_csv(PARSED_ACCOMM_FILE, convert_options=convert_options)["Id"]
+    accommodation_ids = set(pc.utf8_rtrim(ids, characters="_REDUCED").to_pylist())  # New IDs end with "_REDUCED"
+    # Room information obtained so far, including shards left behind by an interrupted run
+    _migrate_room_info()
+    room_info = []
     if os.path.exists(ROOM_INFO_FILE):
-        # If we have already made some room info API calls, remove them from the set of calls to make
-        existing_ids = set(pd.read_csv(ROOM_INFO_FILE).Id.unique())
-        new_ids = accommodation_ids - existing_ids
+        room_info.append(pd.read_parquet(ROOM_INFO_FILE))
+    shard_files = glob.glob(os.path.join(RAW_DATA_ROOM_API_CALL_DIR, "accommodations_nr_rooms_*.csv"))
+    if shard_files:
+        csv_format = ds.CsvFileFormat(
+            convert_options=pa_csv.ConvertOptions(
+                column_types={"Id": pa.string(), "TotalRooms": pa.int32(), "MaxOccupancy": pa.int32()}
+            )
+        )
+        room_info.append(ds.dataset(shard_files, format=csv_format).to_table().to_pandas())
+    # If we have already made some room info API calls, remove them from the set of calls to make
+    existing_ids = set().union(*(df.Id for df in room_info))
+    new_ids = accommodation_ids - existing_ids
     logging.info(f"API calls to make: {len(new_ids):,}")
+    results = asyncio.run(_download_room_info(new_ids))
+
+    room_info.append(pd.DataFrame(results, columns=["Id", "TotalRooms", "MaxOccupancy"]))
+    room_info = pd.concat(room_info).drop_duplicates(subset=["Id"])
+    room_info.to_parquet(ROOM_INFO_FILE, index=False, compression="zstd")
+    # All results are now stored in ROOM_INFO_FILE, hence the checkpoints are no longer needed
+    for shard_file in glob.glob(os.path.join(RAW_DATA_ROOM_API_CALL_DIR, "accommodations_nr_rooms_*.csv")):
+        os.remove(shard_file)
+
+
+def _migrate_room_info():
+    """
+    Converts room information stored in the former CSV format (see `LEGACY_ROOM_INFO_FILE`) to Parquet,
+    unless the Parquet file already exists.
+    """
+    if os.path.exists(ROOM_INFO_FILE) or not os.path.exists(LEGACY_ROOM_INFO_FILE):
+        return
+    logging.info(f"Converting {LEGACY_ROOM_INFO_FILE} to Parquet")
+    room_info = pd.read_csv(LEGACY_ROOM_INFO_FILE, dtype={"Id": str})
+    room_info.to_parquet(ROOM_INFO_FILE, index=False, compression="zstd")
+
+
+async def _download_room_info(accommodation_ids: set) -> list:
+    """
+    Makes room information API calls concurrently, see `download_room_info()`.
+    Results are also saved to disk in batches of 200 as they arrive, so that an interrupted download can be resumed.
+
+    Parameters
+    ----------
+    accommodation_ids: IDs of the tourism establishments for which to obtain room information.
+
+    Returns
+    -------
+    all_results: Room information of each tourism establishment, see `_get_rooms()`.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    api_calls = 0
     results = []
-    for i, accomm_id in enumerate(new_ids):
-        results.append(_get_rooms(accomm_id))
-        api_calls += 1
-        if (api_calls % 200 == 0) | (i == len(new_ids) - 1):
-            results_df = pd.DataFrame(results, columns=["Id", "TotalRooms", "MaxOccupancy"])
-            results_df.to_csv(
-                os.path.join(RAW_DATA_ROOM_API_CALL_DIR, f"accommodations_nr_rooms_{api_calls}_{accomm_id}.csv"),
-                index=False
-            )
-            results = []
-            logging.info(f"Made {api_calls} room info API calls")
-
-    csv_files = glob.glob(os.path.join(RAW_DATA_ROOM_API_CALL_DIR, "accommodations_nr_rooms_*.csv"))
-    results_dfs = pd.concat([pd.read_csv(i) for i in csv_files])
-    results_dfs.drop_duplicates(subset=["Id"], inplace=True)
-    if not os.path.exists(ROOM_INFO_FILE):
-        results_dfs.to_csv(ROOM_INFO_FILE, index=False, mode="a", header=False)
-    else:
-        results_dfs.to_csv(ROOM_INFO_FILE, index=False)
+    all_results = []
+    async with _client_session() as session:
+        tasks = [asyncio.create_task(_get_rooms(session, semaphore, accomm_id)) for accomm_id in accommodation_ids]
+        try:
+            for task in asyncio.as_completed(tasks):
+                accommodation_info = await task
+                results.append(accommodation_info)
+                all_results.append(accommodation_info)
+                api_calls += 1
+                if api_calls % 200 == 0:
+                    _save_room_info_shard(results, api_calls)
+                    results = []
+                    logging.info(f"Made {api_calls} room info API calls")
+        finally:
+            # Also runs if an API call fails for good, so that completed calls need not be made again on resume
+            if results:
+                _save_room_info_shard(results, api_calls)
+                logging.info(f"Made {api_calls} room info API calls")
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    return all_results
 
 
-def _get_rooms(accommodation_id: str, debug: bool = False) -> Union[dict, tuple]:
+def _save_room_info_shard(results: list, api_calls: int):
+    """
+    Saves a batch of room information results to disk, see `_download_room_info()`.
+
+    Parameters
+    ----------
+    results: Room information of the tourism establishments in the batch, see `_get_rooms()`.
+    api_calls: Number of API calls made so far, used to name the file.
+    """
+    accomm_id = results[-1][0]
+    results_df = pd.DataFrame(results, columns=["Id", "TotalRooms", "MaxOccupancy"])
+    results_df.to_csv(
+        os.path.join(RAW_DATA_ROOM_API_CALL_DIR, f"accommodations_nr_rooms_{api_calls}_{accomm_id}.csv"),
+        index=False
+    )
+
+
+async def _get_rooms(
+        session: aiohttp.ClientSession,
+        semaphore: asyncio.Semaphore,
+        accommodation_id: str,
+        debug: bool = False
+) -> Union[dict, tuple]:
     """
     Obtains room information for a given tourism establishment.
 
     Parameters
     ----------
+    session: The HTTP session used to make the API call.
+    semaphore: Semaphore limiting the number of concurrent API calls.
     accommodation_id: ID of the tourism establishment
     debug: Whether to enter debug mode and return the results of the API call as-is.
 
@@ -244,38 +404,18 @@ def _get_rooms(accommodation_id: str, debug: bool = False) -> Union[dict, tuple]
     url_main = f"https://tourism.api.opendatahub.bz.it/v1/AccommodationRoom?accoid={accommodation_id}&"
     url_settings = "idsource=lts&getall=true&language=de&removenullvalues=true"
     url = url_main + url_settings
-    with urllib.request.urlopen(url) as response:
-        content = response.read()
-        data = json.loads(content)
-        if debug:
-            return data
-        nr_rooms = np.array([d["RoomQuantity"] for d in data])
-        max_occupancy = np.array([d["Roommax"] for d in data])
-        total_rooms = int(nr_rooms.sum())
-        total_max_occupancy = int((nr_rooms * max_occupancy).sum())
-        accommodation_info = tuple([accommodation_id, total_rooms, total_max_occupancy])
-        return accommodation_info
-
-
-def _parse_category(x: str) -> Tuple[Union[str, None], Union[str, None]]:
-    """
-
-    Parameters
-    ----------
-    x: Category, such as "3sstars"
-
-    Returns
-    -------
-    Category rank and type, e.g. (3s, stars)
-    """
-    if x != "Not categorized":
-        if "ss" in x:
-            # 4s or 3s hotels
-            return x[:2], x[2:]
-        else:
-            return x[:1], x[1:]
-    else:
-        return None, None
+    data = orjson.loads(await _fetch(session, semaphore, url))
+    if debug:
+        return data
+    # Plain loop: room lists are short, so numpy's per-call overhead would outweigh the arithmetic
+    total_rooms = 0
+    total_max_occupancy = 0
+    for d in data:
+        nr_rooms = d["RoomQuantity"]
+        total_rooms += nr_rooms
+        total_max_occupancy += nr_rooms * d["Roommax"]
+    accommodation_info = (accommodation_id, int(total_rooms), int(total_max_occupancy))
+    return accommodation_info
 
 
 def prepare_dirs():
@@ -1,23 +1,66 @@
+import os
 import streamlit as st
+import streamlit.components.v1 as components
 import holoviews as hv
-import pickle
+import geopandas as gpd
+from bokeh.embed import file_html
+from bokeh.resources import INLINE
 from utils import (
     define_municipality_map,
     define_density_map,
+    read_density_data,
 )
 from config import (
     VARIABLES_INV,
+    MUNICIPALITY_KPI_OPTIONS,
     MUNICIPALITY_FILE,
     DENSITY_FILE,
+    BASEMAP_FILE,
 )
 
 
+@st.cache_resource(show_spinner="Loading tourism data…")
+def load_file(path):
+    # Loaded once per process, so that widget interactions only re-render the map
+    extension = os.path.splitext(path)[1]
+    if extension == ".parquet":
+        return gpd.read_parquet(path)
+    elif extension == ".npz":
+        return read_density_data(path, BASEMAP_FILE)
+    else:
+        raise NotImplementedError(f"Loading {extension} files is not supported")
+
+
 def get_data(selection):
     # Note: In docker image => these files already exist
     if selection == "by Municipality":
-        return pickle.load(open(MUNICIPALITY_FILE, "rb"))
+        return load_file(MUNICIPALITY_FILE)
     elif selection == "by GPS":
-        return pickle.load(open(DENSITY_FILE, "rb"))
+        return load_file(DENSITY_FILE)
+
+
+def get_visualisation(map_type, kpi, tooltip_all_kpis):
+    tourism_data = get_data(map_type)
+    if map_type == "by Municipality":
+        return define_municipality_map(
+            data=tourism_data,
+            color_col=VARIABLES_INV[kpi],
+            title=kpi + " " + map_type,
+            clabel=kpi,
+            tooltip_all_kpis=tooltip_all_kpis
+        )
+    elif map_type == "by GPS":
+        return define_density_map(**tourism_data)
+    else:
+        raise NotImplementedError()
+
+
+@st.cache_resource
+def render_html(map_type, kpi, tooltip_all_kpis):
+    # Rendered in memory and cached, so that reruns with the same selection skip the Bokeh rendering
+    # BokehJS is inlined, so that, like st.bokeh_chart, the dashboard does not rely on an external CDN
+    visualisation = get_visualisation(map_type, kpi, tooltip_all_kpis)
+    return file_html(hv.render(visualisation, backend='bokeh'), INLINE, app_title)
 
 
 app_title = 'Tourism in South Tyrol'
@@ -32,33 +75,17 @@ select_map_type = st.sidebar.selectbox(
 # KPI to visualise
 text = "Please choose the metric to visualise: "
 if select_map_type == "by Municipality":
-    select_kpi = st.sidebar.selectbox(
-        text,
-        [i for i in VARIABLES_INV.keys() if i not in ["Municipality (de)", "Municipality (it)"]]
-    )
+    select_kpi = st.sidebar.selectbox(text, MUNICIPALITY_KPI_OPTIONS)
 else:
     select_kpi = st.sidebar.selectbox(text, ["Number of Tourism Establishments"])
-kpi_col_name = VARIABLES_INV[select_kpi]
 # Visualisation options:
 if select_map_type == "by Municipality":
     select_all_kpis_tooltip = st.sidebar.radio("Include all available KPIs in tooltip: ", [True, False])
 else:
     select_all_kpis_tooltip = None
 # --------- Generate Visualisations
-tourism_data = get_data(select_map_type)
-if select_map_type == "by Municipality":
-    visualisation = define_municipality_map(
-        data=tourism_data,
-        color_col=kpi_col_name,
-        title=select_kpi + " " + select_map_type,
-        clabel=select_kpi,
-        tooltip_all_kpis=select_all_kpis_tooltip
-    )
-elif select_map_type == "by GPS":
-    visualisation = define_density_map(**tourism_data)
-else:
-    raise NotImplementedError()
+visualisation_html = render_html(select_map_type, select_kpi, select_all_kpis_tooltip)
 
 # --------- Main Page
 st.title('Tourism in South Tyrol')
-st.bokeh_chart(hv.render(visualisation, backend='bokeh'))
+components.html(visualisation_html, width=950, height=650)
\ No newline at end of file
@@ -25,7 +25,7 @@ RAW_DATA_ROOM_API_CALL_DIR = os.path.join(RAW_DATA_API_DIR, "room_info")
 # Directory where edited, i.e. prepared data, will be stored
 PREPARED_DATA_DIR = os.path.join(DATA_DIR, "prepared_data")
 
-# Directory where pickle files for the dashboard are stored
+# Directory where data files for the dashboard are stored
 DASHBOARD_DATA_DIR = os.path.join(DATA_DIR, "dashboard_data")
 
 # Directory where plots will be stored
@@ -55,16 +55,45 @@ POPULATION_SHAPEFILE = os.path.join(*[
     "OfficialResidentPopulation_polygon.shp"
 ])
 
+# Engine used by geopandas to read the raw files: reads features in bulk rather than one-by-one
+GEO_IO_ENGINE = "pyogrio"
+
 # Prepared files
 # --------------
 PARSED_ACCOMM_FILE = os.path.join(PREPARED_DATA_DIR, "accommodations_parsed.csv")
 PREPARED_ACCOMM_FILE = os.path.join(PREPARED_DATA_DIR, "accommodations_cleaned.csv")
-ROOM_INFO_FILE = os.path.join(PREPARED_DATA_DIR, "accommodation_rooms.csv")
+# Same content as PREPARED_ACCOMM_FILE, but typed and columnar, hence much faster to read
+PREPARED_ACCOMM_PARQUET = os.path.join(PREPARED_DATA_DIR, "accommodations_cleaned.parquet")
+ROOM_INFO_FILE = os.path.join(PREPARED_DATA_DIR, "accommodation_rooms.parquet")
+# Former CSV version of ROOM_INFO_FILE, converted to Parquet the first time it is found
+LEGACY_ROOM_INFO_FILE = os.path.join(PREPARED_DATA_DIR, "accommodation_rooms.csv")
+POPULATION_FILE = os.path.join(PREPARED_DATA_DIR, "population.parquet")
 
 # Dashboard files
 # ---------------
-MUNICIPALITY_FILE = os.path.join(DASHBOARD_DATA_DIR, "municipality.pickle")
-DENSITY_FILE = os.path.join(DASHBOARD_DATA_DIR, "density.pickle")
+MUNICIPALITY_FILE = os.path.join(DASHBOARD_DATA_DIR, "municipality.parquet")
+DENSITY_FILE = os.path.join(DASHBOARD_DATA_DIR, "density.npz")
+BASEMAP_FILE = os.path.join(DASHBOARD_DATA_DIR, "basemap.parquet")
+
+# Geography
+# ---------
+# Bounding box of South Tyrol (WGS84), used to discard establishments with invalid GPS coordinates
+LATITUDE_RANGE = (46.2, 47.1)
+LONGITUDE_RANGE = (10.4, 12.5)
+
+# Column types of PARSED_ACCOMM_FILE, so that pandas does not have to infer them when reading the file
+PARSED_ACCOMM_DTYPES = {
+    "Name": str,
+    "City": str,
+    "AccoCategoryId": str,
+    "AccoRoomInfo": "float64",
+    "LocationInfo": str,
+    "Altitude": "float64",
+    "Latitude": "float64",
+    "Longitude": "float64",
+    "Id": str,
+    "file": str
+}
 
 # Variables
 # ---------
@@ -96,6 +125,8 @@ VARIABLES_PRETTY = {k: v[0] for k, v in VARIABLES_INFO.items()}
 # Name: KPI mapping to be used in the streamlit app
 # Allow users to select KPI using nicely formatted names
 VARIABLES_INV = {v[0]: k for k, v in VARIABLES_INFO.items()}
+# KPIs the user can choose from in the streamlit app when visualising municipalities
+MUNICIPALITY_KPI_OPTIONS = tuple(v[0] for k, v in VARIABLES_INFO.items() if k not in ("NAME_D", "NAME_I"))
 
 MAPPING_CATEGORY_SINGULAR_PLURAL = {
     "flower": "flowers",
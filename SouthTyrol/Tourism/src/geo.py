@@ -0,0 +1,68 @@
+from functools import lru_cache
+import glob
+import os
+import geopandas as gpd
+
+from config import (
+    POPULATION_SHAPEFILE,
+    POPULATION_FILE,
+    GEO_IO_ENGINE
+)
+
+
+def ensure_wgs84(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """
+    Makes sure a geo-dataframe uses WGS84 (EPSG:4326) coordinates, only reprojecting if its CRS actually differs.
+
+    Parameters
+    ----------
+    gdf: The geo-dataframe whose coordinate reference system should be checked.
+
+    Returns
+    -------
+    gdf: The geo-dataframe in WGS84 coordinates.
+    """
+    if gdf.crs is None:
+        gdf = gdf.set_crs("EPSG:4326")
+    elif gdf.crs.to_epsg() != 4326:
+        gdf = gdf.to_crs("EPSG:4326")
+    return gdf
+
+
+@lru_cache(maxsize=None)
+def load_population() -> gpd.GeoDataFrame:
+    """
+    Loads the population data of South Tyrol's municipalities.
+    The original shapefile is converted to GeoParquet, which is much faster to read thereafter.
+    The conversion is repeated whenever the shapefile is more recent than the GeoParquet file.
+    The result is cached, hence it should not be modified in-place by the caller.
+
+    Returns
+    -------
+    population: Geo-dataframe with one row per municipality, containing its population and boundary.
+    """
+    if _is_outdated(POPULATION_FILE, POPULATION_SHAPEFILE):
+        population = ensure_wgs84(gpd.read_file(POPULATION_SHAPEFILE, engine=GEO_IO_ENGINE))
+        population.drop_duplicates(subset=["NAME_D"], inplace=True)
+        population.to_parquet(POPULATION_FILE)
+    return gpd.read_parquet(POPULATION_FILE)
+
+
+def _is_outdated(converted_file: str, shapefile: str) -> bool:
+    """
+    Checks whether a file converted from a shapefile is missing or older than any of the shapefile's components.
+
+    Parameters
+    ----------
+    converted_file: Path of the file the shapefile was converted to.
+    shapefile: Path of the .shp file. Its sidecar files (.dbf, .prj, ...) are checked as well.
+
+    Returns
+    -------
+    outdated: Whether the converted file should be (re-)created.
+    """
+    if not os.path.exists(converted_file):
+        return True
+    components = glob.glob(os.path.splitext(shapefile)[0] + ".*")
+    # Without the shapefile, the converted file is all there is
+    return any(os.path.getmtime(f) > os.path.getmtime(converted_file) for f in components)
@@ -1,18 +1,19 @@
 import os
-import pickle
 
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-import geoviews as gv
 
 from config import (
     RAW_DATA_DIR,
-    PREPARED_ACCOMM_FILE,
+    GEO_IO_ENGINE,
+    PREPARED_ACCOMM_PARQUET,
     DENSITY_FILE,
-    MUNICIPALITY_FILE,
-    POPULATION_SHAPEFILE
+    BASEMAP_FILE,
+    MUNICIPALITY_FILE
 )
 from utils import get_kernel_density
+from geo import load_population, ensure_wgs84
 
 
 def load_municipality_data() -> pd.DataFrame:
@@ -26,18 +27,21 @@ def load_municipality_data() -> pd.DataFrame:
                 See src.config.VARIABLES_INFO for a list of variables available.
     """
 
-    # Load accommodation data
-    df = pd.read_csv(PREPARED_ACCOMM_FILE)
-    df_geo = gpd.GeoDataFrame(df, crs="EPSG:4326")
+    # Load accommodation data, restricted to the columns that are aggregated below
+    usecols = [
+        "Id", "NAME_D", "NAME_I", "MaxOccupancy", "TotalRooms",
+        "AccoCategoryRating_1", "AccoCategoryRating_2", "AccoCategoryRating_3", "AccoCategoryRating_3S",
+        "AccoCategoryRating_4", "AccoCategoryRating_4S", "AccoCategoryRating_5",
+        "AccoCategoryType_Stars", "AccoCategoryType_Suns", "AccoCategoryType_Flowers"
+    ]
+    df = pd.read_parquet(PREPARED_ACCOMM_PARQUET, columns=usecols)
 
     # Load population data
-    population = gpd.read_file(POPULATION_SHAPEFILE, crs="EPSG:4326")
-    population = population.to_crs("EPSG:4326")
-    population.drop_duplicates(subset=["NAME_D"], inplace=True)
+    population = load_population()
 
     # Aggregate information on municipality level
     tourism_df = (
-        df_geo
+        df
         .groupby(["NAME_D", "NAME_I"])
         .agg(
             nr_establishments=("Id", "count"),
@@ -66,8 +70,8 @@ def load_municipality_data() -> pd.DataFrame:
     )
     # Make sure share columns are actually in percentages
     share_cols = [i for i in tourism_df.columns if i.startswith("share_")]
-    for c in share_cols:
-        tourism_df[c] = tourism_df[c] / tourism_df.nr_establishments * 100
+    denom = tourism_df["nr_establishments"].to_numpy()[:, None]
+    tourism_df[share_cols] = tourism_df[share_cols].to_numpy() / denom * 100.0
     assert tourism_df.NAME_D.nunique() == len(tourism_df)
 
     # Ensure dataframe is a geo-dataframe
@@ -78,35 +82,33 @@ def load_municipality_data() -> pd.DataFrame:
 
 def load_density_data() -> dict:
     """
-    Transforms dataframe containing coordinates of tourism establishments into a geo-dataframe.
-    From this dataframe, kernel density estimation is applied to measure the density of tourism establishments
-    across South Tyrol. In order to visualise this map later, a basemap outlining the province is read in.
-    All information is packaged in a dictionary for later use in `define_density_map()`
+    Reads in the coordinates of tourism establishments and applies kernel density estimation to measure the density
+    of tourism establishments across South Tyrol. In order to visualise this map later, a basemap outlining the
+    province is read in. All information is packaged in a dictionary for later use in `save_density_data()`.
 
     Returns
     -------
     out_dict: A dictionary containing all necessary variables to create a density plot.
     """
     # Load accommodation data
-    df = pd.read_csv(PREPARED_ACCOMM_FILE)
+    df = (
+        pd.read_parquet(PREPARED_ACCOMM_PARQUET, columns=["City", "Latitude", "Longitude"])
+        .astype({"Latitude": np.float32, "Longitude": np.float32})
+    )
 
     # Read in province shapefiles
     province_shape = gpd.read_file(
         os.path.join(RAW_DATA_DIR, "shapefiles/Limiti01012021_g/ProvCM01012021_g/ProvCM01012021_g_WGS84.shp"),
-        crs="EPSG:4326"
+        engine=GEO_IO_ENGINE
     )
-    province_shape_projected = province_shape.to_crs('EPSG:4326')
+    province_shape_projected = ensure_wgs84(province_shape)
     south_tyrol = province_shape_projected.query("SIGLA == 'BZ'")
 
-    establishments = gv.Dataset(df, kdims=['City', 'Latitude', 'Longitude'])
-    establishments = establishments.to(gv.Points, ['Longitude', 'Latitude'], ['City'])
-    basemap = gv.Polygons(south_tyrol)
-
     y_grid, x_grid, z_grid_masked = get_kernel_density(df, south_tyrol)
 
     out_dict = {
-        "establishments": establishments,
-        "basemap": basemap,
+        "establishments": df[["City", "Latitude", "Longitude"]],
+        "basemap": south_tyrol,
         "y_grid": y_grid,
         "x_grid": x_grid,
         "z_grid_masked": z_grid_masked
@@ -115,8 +117,31 @@ def load_density_data() -> dict:
     return out_dict
 
 
+def save_density_data(density_data: dict):
+    """
+    Saves the output of `load_density_data()` for use in the dashboard.
+    The kernel density grids and the establishments' coordinates are stored as a compressed numpy archive,
+    while the basemap is stored as GeoParquet. See src.utils.read_density_data() for the inverse operation.
+
+    Parameters
+    ----------
+    density_data: The dictionary returned by `load_density_data()`.
+    """
+    establishments = density_data["establishments"]
+    np.savez_compressed(
+        DENSITY_FILE,
+        y_grid=density_data["y_grid"],
+        x_grid=density_data["x_grid"],
+        z_grid_masked=density_data["z_grid_masked"],
+        city=establishments["City"].fillna("").to_numpy(dtype=str),
+        latitude=establishments["Latitude"].to_numpy(),
+        longitude=establishments["Longitude"].to_numpy()
+    )
+    density_data["basemap"].to_parquet(BASEMAP_FILE, compression="zstd")
+
+
 if __name__ == '__main__':
     d_density = load_density_data()
     df_municipality = load_municipality_data()
-    pickle.dump(d_density, open(DENSITY_FILE, "wb"))
-    pickle.dump(df_municipality, open(MUNICIPALITY_FILE, "wb"))
+    save_density_data(d_density)
+    df_municipality.to_parquet(MUNICIPALITY_FILE, compression="zstd")
@@ -4,10 +4,80 @@ import geopandas as gpd
 import geoviews as gv
 from bokeh.models import HoverTool
 import numpy as np
-from sklearn.neighbors import KernelDensity
+import shapely
 
 from config import VARIABLES_INFO
 
+# Bandwidth (in degrees) of the Gaussian kernel used for the density map
+KDE_BANDWIDTH = 0.03
+
+# Tooltips and value dimensions of the municipality map only depend on the config, hence are computed once
+_TOOLTIPS_ALL = [(v[0], "@" + k + v[1]) for k, v in VARIABLES_INFO.items()]
+# Municipality info is kept in the tooltip no matter which KPI is selected
+_TOOLTIPS_MUNICIPALITY = [(v[0], "@" + k + v[1]) for k, v in VARIABLES_INFO.items() if k in ["NAME_D", "NAME_I"]]
+_TOOLTIPS_BY_KPI = {
+    k: [(v[0], "@" + k + v[1])] + _TOOLTIPS_MUNICIPALITY for k, v in VARIABLES_INFO.items()
+}
+_VDIMS = list(VARIABLES_INFO)
+
+
+def _binned_kde_log(x_axis: np.ndarray, y_axis: np.ndarray, xs: np.ndarray, ys: np.ndarray, h: float) -> np.ndarray:
+    """
+    Approximates the log-density of a 2D Gaussian kernel density estimate on a regular grid.
+    Samples are binned to their nearest node of the grid, which is extended where needed so that no sample is dropped.
+    The Gaussian kernel, being separable, is then applied along each axis as a matrix product.
+    The cost hence depends on the grid size only, not on the number of samples.
+
+    Parameters
+    ----------
+    x_axis: The (evenly spaced) x coordinates of the grid.
+    y_axis: The (evenly spaced) y coordinates of the grid.
+    xs: The x coordinates of the samples the density is estimated from.
+    ys: The y coordinates of the samples the density is estimated from.
+    h: The bandwidth of the Gaussian kernel.
+
+    Returns
+    -------
+    out: The log-density at each grid node, of shape (len(x_axis), len(y_axis)).
+    """
+    # Kernel weights are computed in double precision, as their products underflow in single precision far from samples
+    x_axis, y_axis = x_axis.astype(np.float64), y_axis.astype(np.float64)
+    x_nodes = _extend_axis(x_axis, xs)
+    y_nodes = _extend_axis(y_axis, ys)
+    # Bin edges lie halfway between nodes
+    dx = x_nodes[1] - x_nodes[0]
+    dy = y_nodes[1] - y_nodes[0]
+    x_edges = np.append(x_nodes - dx / 2, x_nodes[-1] + dx / 2)
+    y_edges = np.append(y_nodes - dy / 2, y_nodes[-1] + dy / 2)
+    counts, _, _ = np.histogram2d(xs, ys, bins=[x_edges, y_edges])
+    # Kernel weights between every grid node and every (extended) node along each axis
+    kernel_x = np.exp(-0.5 * ((x_axis[:, None] - x_nodes[None, :]) / h) ** 2)
+    kernel_y = np.exp(-0.5 * ((y_axis[:, None] - y_nodes[None, :]) / h) ** 2)
+    density = kernel_x @ counts @ kernel_y.T / (xs.size * 2 * np.pi * h ** 2)
+    with np.errstate(divide="ignore"):
+        out = np.log(density)
+    return out
+
+
+def _extend_axis(axis: np.ndarray, samples: np.ndarray) -> np.ndarray:
+    """
+    Extends an evenly spaced axis with nodes of the same spacing until it covers the range of the given samples.
+
+    Parameters
+    ----------
+    axis: The (evenly spaced) coordinates of the grid along one axis.
+    samples: The coordinates of the samples along the same axis.
+
+    Returns
+    -------
+    nodes: The extended axis, which contains the original axis.
+    """
+    step = axis[1] - axis[0]
+    n_lower = int(np.ceil(max(axis[0] - samples.min(), 0) / step))
+    n_upper = int(np.ceil(max(samples.max() - axis[-1], 0) / step))
+    nodes = axis[0] + step * np.arange(-n_lower, axis.size + n_upper)
+    return nodes
+
 
 def define_municipality_map(
         data: pd.DataFrame,
@@ -33,26 +103,13 @@ def define_municipality_map(
     visualisation: Bokeh choropleth map at municipality level with the colouring defined by the `color_col` variable.
     """
 
-    if not tooltip_all_kpis:
-        v = VARIABLES_INFO[color_col]
-        # KPI to show
-        tooltips = [(v[0], "@" + color_col + v[1])]
-        # Keep municipality info no matter what
-        municipality_info = {k: v for k, v in VARIABLES_INFO.items() if k in ["NAME_D", "NAME_I"]}
-        tooltips += [
-            (v[0], "@" + k + v[1]) for k, v in municipality_info.items()
-        ]
-    else:
-        tooltips = [
-            (v[0], "@" + k + v[1]) for k, v in VARIABLES_INFO.items()
-        ]
-
+    tooltips = _TOOLTIPS_ALL if tooltip_all_kpis else _TOOLTIPS_BY_KPI[color_col]
     hover = HoverTool(tooltips=tooltips)
     # TODO: Cap cmap at 95th percentile
     visualisation = (
         gv.Polygons(
             data,
-            vdims=list(VARIABLES_INFO.keys())
+            vdims=_VDIMS
         )
         .opts(
             tools=[hover], width=900, height=600, color=color_col,
@@ -177,6 +234,36 @@ def save_map(figure: gv.Polygons, filename: str, filetype: str = "html"):
         raise Exception(f"Saving map as {filetype} is not supported")
 
 
+def read_density_data(density_file: str, basemap_file: str) -> dict:
+    """
+    Reads the files written by src.prepare_data.save_density_data() and rebuilds the geoviews objects needed
+    to create a density plot.
+
+    Parameters
+    ----------
+    density_file: Path to the compressed numpy archive containing the kernel density grids and establishments.
+    basemap_file: Path to the GeoParquet file containing the outline of South Tyrol.
+
+    Returns
+    -------
+    density_data: A dictionary containing all necessary variables to call `define_density_map()`.
+    """
+    with np.load(density_file) as arrays:
+        establishments = pd.DataFrame({
+            "City": arrays["city"],
+            "Latitude": arrays["latitude"],
+            "Longitude": arrays["longitude"]
+        })
+        density_data = {
+            "establishments": gv.Points(establishments, ["Longitude", "Latitude"], ["City"]),
+            "basemap": gv.Polygons(gpd.read_parquet(basemap_file)),
+            "y_grid": arrays["y_grid"],
+            "x_grid": arrays["x_grid"],
+            "z_grid_masked": arrays["z_grid_masked"]
+        }
+    return density_data
+
+
 def get_kernel_density(df: pd.DataFrame, basemap: gpd.GeoDataFrame) -> Tuple[np.array, np.array, np.array]:
     """
     Performs kernel density estimation on the GPS coordinates of tourism establishments in South Tyrol.
@@ -191,31 +278,28 @@ def get_kernel_density(df: pd.DataFrame, basemap: gpd.GeoDataFrame) -> Tuple[np.
     kernel_estimates: The y, x, z coordinates of the kernel density estimation.
     """
     # Define grid for on which KDE should be applied
-    n_samples = 200j
+    n_samples = 200
     # Based on establishments
     # xmin, xmax = df.Latitude.min(), df.Latitude.max()
     # ymin, ymax = df.Longitude.min(), df.Longitude.max()
     # Based on basemap
     ymin, xmin, ymax, xmax = basemap.geometry.iloc[0].bounds
-    x_grid, y_grid = np.mgrid[xmin:xmax:n_samples, ymin:ymax:n_samples]
-    grid = np.vstack([x_grid.ravel(), y_grid.ravel()])
-    # Data on which KDE should be fitted
-    lat_long = df[["Latitude", "Longitude"]].values
-    # Fit KDE
-    kde = KernelDensity(bandwidth=0.03)
-    kde.fit(lat_long)
-    # Apply KDE on grid
-    z_grid = kde.score_samples(grid.T).reshape(x_grid.shape)
+    # Single precision is plenty for plotting and halves the size of the stored and rendered grids
+    x_axis = np.linspace(xmin, xmax, n_samples, dtype=np.float32)
+    y_axis = np.linspace(ymin, ymax, n_samples, dtype=np.float32)
+    x_grid, y_grid = np.meshgrid(x_axis, y_axis, indexing="ij")
+    xg, yg = x_grid.ravel(), y_grid.ravel()
+    # We only want to plot densities within the basemap's boundaries
+    # Note: shapely expects (x, y) = (longitude, latitude), i.e. (yg, xg) here
+    poly = basemap.geometry.unary_union
+    inside = shapely.contains_xy(poly, yg, xg)
+    # Apply KDE, fitted on the establishments' coordinates, on grid
+    z_grid = _binned_kde_log(x_axis, y_axis, df.Latitude.values, df.Longitude.values, KDE_BANDWIDTH)
+    z_grid_masked = np.where(inside.reshape(x_grid.shape), z_grid, np.nan)
 
     # Alternative:
     # kernel = stats.gaussian_kde(values, bw_method=0.1)
     # z_grid = np.reshape(kernel(grid).T, x_grid.shape)
 
-    # If we only want to plot densities within the basemap's boundaries
-    coords = np.vstack([x_grid.flatten(), y_grid.flatten(), z_grid.flatten()]).T
-    coords = gpd.GeoDataFrame(coords, geometry=gpd.points_from_xy(coords[:, 1], coords[:, 0]))
-    coords.columns = ["Latitude", "Longitude", "Z", "geometry"]
-    coords["flag"] = coords.geometry.apply(lambda x: basemap.geometry.contains(x))
-    z_grid_masked = np.where(coords.flag, coords.Z, np.NaN).reshape(z_grid.shape)
-    kernel_estimates = (y_grid, x_grid, z_grid_masked)
+    kernel_estimates = (y_grid, x_grid, z_grid_masked.astype(np.float32))
     return kernel_estimates